@@ -4,19 +4,132 @@ from fastapi.middleware.cors import CORSMiddleware
 import cv2
 import numpy as np
 from PIL import Image
-import io
 import torch
 import torch.nn.functional as F
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 import logging
 import base64
 import asyncio
+import concurrent.futures
+import io
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+import os
+import queue
+import threading
+from collections import OrderedDict, deque
+
+try:
+    import tensorrt as trt
+except ImportError:  # TensorRT is optional; fall back to PyTorch inference
+    trt = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJPF_GRAY, TJSAMP_GRAY
+except ImportError:  # PyTurboJPEG is optional; fall back to OpenCV codecs
+    TurboJPEG = None
+
+try:
+    import onnxruntime as ort
+except ImportError:  # ONNX Runtime is optional; used for non-CUDA inference
+    ort = None
+
+try:
+    from numba import njit, prange
+except ImportError:  # Numba is optional; fall back to NumPy
+    njit = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Auto Focus Depth Blur API", version="1.0.0")
+# MiDaS_small is trained at 256x256
+MIDAS_INPUT_SIZE = 256
+MIDAS_MEAN = (0.485, 0.456, 0.406)
+MIDAS_STD = (0.229, 0.224, 0.225)
+
+# TensorRT engine settings
+TRT_INPUT_SIZE = MIDAS_INPUT_SIZE
+TRT_CACHE_DIR = os.path.expanduser("~/.cache")
+
+# ONNX Runtime settings (used when CUDA is unavailable)
+ORT_INPUT_SIZE = MIDAS_INPUT_SIZE
+ORT_CACHE_DIR = os.path.expanduser("~/.cache")
+ONNX_OPSET = 17
+ORT_PROVIDERS = [
+    "DmlExecutionProvider",
+    "CoreMLExecutionProvider",
+    "CPUExecutionProvider",
+]
+
+# Micro-batching of concurrent depth requests
+MAX_BATCH_SIZE = 8
+BATCH_WAIT_MS = 5
+
+# Images larger than this (longest side) are downscaled for processing,
+# then padded to this square
+MAX_PROCESSING_SIZE = 512
+
+# CUDA streams (with pinned buffers), one per request worker plus the batch thread
+CUDA_STREAMS = MAX_BATCH_SIZE + 1
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _fused_blur_intensity(depth_map, focus_plane, focus_range, valid_height,
+                              valid_width, out):
+        """Distance from the focus plane, normalized to 0-1 with in-focus pixels zeroed
+        
+        The maximum is taken over the top-left valid_height x valid_width region
+        only, so letterbox padding does not affect the normalization.
+        """
+        height, width = depth_map.shape
+        
+        # Pass 1: distance from focus plane, with per-row maxima over the valid region
+        row_max = np.zeros(height, dtype=np.float32)
+        for y in prange(height):
+            local_max = np.float32(0.0)
+            for x in range(width):
+                distance = abs(depth_map[y, x] - focus_plane)
+                out[y, x] = distance
+                if y < valid_height and x < valid_width and distance > local_max:
+                    local_max = distance
+            row_max[y] = local_max
+        
+        max_distance = row_max.max()
+        scale = np.float32(1.0 / max_distance) if max_distance > 0 else np.float32(0.0)
+        
+        # Pass 2: normalize and zero areas within focus range
+        for y in prange(height):
+            for x in range(width):
+                distance = out[y, x]
+                out[y, x] = 0.0 if distance <= focus_range else min(distance * scale, 1.0)
+        
+        return out
+else:
+    _fused_blur_intensity = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load and warm up the depth model in the background at startup.
+    
+    Loading runs as a task so the server starts listening immediately (blocking
+    startup on the model download caused deploy timeouts). The download, engine
+    build and warmup themselves run on the request executor, so the event loop
+    keeps serving meanwhile; requests that arrive early wait in
+    ensure_model_loaded.
+    """
+    async def load_in_background():
+        try:
+            await processor.load_depth_model()
+        except Exception:
+            pass  # Already logged; the next request retries via ensure_model_loaded
+    
+    processor._start_batch_worker()
+    load_task = asyncio.create_task(load_in_background())
+    yield
+    load_task.cancel()
+    processor.shutdown()
+
+app = FastAPI(title="Auto Focus Depth Blur API", version="1.0.0", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -27,14 +140,133 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+class _BufferPool:
+    """Free list of preallocated scratch buffers, one set per in-flight request"""
+    
+    def __init__(self, max_size: int = MAX_PROCESSING_SIZE):
+        self.max_pixels = max_size * max_size
+        self._free = deque()
+    
+    def _allocate(self) -> Dict[str, np.ndarray]:
+        pixels = self.max_pixels
+        return {
+            "image": np.empty(pixels * 3, dtype=np.uint8),
+            "result": np.empty(pixels * 3, dtype=np.uint8),
+            "blurred": np.empty(pixels * 3, dtype=np.uint8),
+            "maps": np.empty(pixels * 2, dtype=np.float32),  # depth map + blur mask
+            "scratch": np.empty(pixels, dtype=np.float32),
+        }
+    
+    def acquire(self) -> Dict[str, np.ndarray]:
+        try:
+            return self._free.pop()
+        except IndexError:
+            return self._allocate()
+    
+    def release(self, buffers: Dict[str, np.ndarray]):
+        self._free.append(buffers)
+    
+    @staticmethod
+    def view(buffer: np.ndarray, shape: Tuple[int, ...]) -> np.ndarray:
+        """Contiguous view of the start of a flat buffer with the given shape"""
+        return buffer[:int(np.prod(shape))].reshape(shape)
+
+class _StreamPool:
+    """Fixed pool of CUDA streams, each with pinned host staging buffers.
+    
+    A slot is held exclusively for a whole request, so its pinned buffers
+    can be reused for async copies without racing another request. All slots
+    are allocated up front; acquire blocks until one is free rather than
+    pinning more memory on the request path.
+    """
+    
+    def __init__(self, device: torch.device, size: int = CUDA_STREAMS,
+                 max_size: int = MAX_PROCESSING_SIZE):
+        self.device = device
+        self.max_pixels = max_size * max_size
+        self._slots = queue.Queue()
+        for _ in range(size):
+            self._slots.put(self._allocate())
+    
+    def _allocate(self) -> Dict[str, Any]:
+        pixels = self.max_pixels
+        return {
+            "stream": torch.cuda.Stream(device=self.device),
+            "image": torch.empty(pixels * 3, dtype=torch.uint8, pin_memory=True),
+            "maps": torch.empty(pixels * 2, dtype=torch.float32, pin_memory=True),
+        }
+    
+    def acquire(self) -> Dict[str, Any]:
+        return self._slots.get()
+    
+    def release(self, slot: Dict[str, Any]):
+        self._slots.put(slot)
+    
+    @contextmanager
+    def stream(self):
+        """Run the enclosed CUDA work on a stream from the pool"""
+        slot = self.acquire()
+        try:
+            with torch.cuda.stream(slot["stream"]):
+                yield slot["stream"]
+        finally:
+            self.release(slot)
+
 class AutoFocusProcessor:
     def __init__(self):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        if self.device.type == 'cuda':
+            # Input shapes are fixed, so the cuDNN autotuner result is reused
+            torch.backends.cudnn.benchmark = True
         self.model = None
-        self.transform = None
+        # Device-side constants, created at load time so importing this module
+        # never initializes CUDA (fork-based servers preload it)
+        self.input_mean = None
+        self.input_std = None
+        self.mask_kernel = None
+        self.trt_engine = None
+        self.trt_context = None
+        self.trt_stream = None
+        self.trt_input = None
+        self.trt_output = None
+        self.ort_session = None
+        self.ort_binding = None
+        self.ort_input = None
+        self.ort_output = None
+        self.autocast_dtype = None
+        self._eager_model = None  # uncompiled model, kept as a fallback for torch.compile
+        # 21x21 Gaussian (sigma derived by OpenCV) used to smooth the blur mask
+        self._gauss_kx = cv2.getGaussianKernel(21, 0).astype(np.float32)
+        # Small LRU cache of Gaussian kernels keyed by (kernel_size, sigma)
+        self._blur_kernels = OrderedDict()
+        self._kernel_lock = threading.Lock()
+        # Numba's parallel kernels must not be entered from several threads at once
+        # (the workqueue threading layer aborts; others oversubscribe the cores)
+        self._numba_lock = threading.Lock()
+        self._buffers = _BufferPool()
+        self._jpeg = None
+        if TurboJPEG is not None:
+            try:
+                self._jpeg = TurboJPEG()
+            except Exception as e:  # libturbojpeg shared library not found
+                logger.warning(f"libjpeg-turbo unavailable, using OpenCV codecs: {e}")
         self.models_loaded = False
         self.model_loading = False
         
+        # Blocking image processing runs off the event loop; on CUDA, each
+        # request runs on its own stream so copies and compute overlap
+        # (the pool is created with the batch worker, not at import)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_BATCH_SIZE)
+        self._streams: Optional[_StreamPool] = None
+        self._trt_lock = threading.Lock()
+        self._ort_lock = threading.Lock()
+        
+        # Concurrent depth requests are coalesced into batched forward passes
+        self._batch_queue: Optional[asyncio.Queue] = None
+        self._batch_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._batch_task: Optional[asyncio.Task] = None
+        self._batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        
     async def ensure_model_loaded(self):
         """Ensure model is loaded (lazy loading)"""
         if self.models_loaded:
@@ -55,16 +287,13 @@ class AutoFocusProcessor:
             
         self.model_loading = True
         logger.info("Starting to load MiDaS model...")
+        loop = asyncio.get_running_loop()
         
         try:
-            # Load MiDaS small model (faster than full MiDaS)
-            self.model = torch.hub.load("intel-isl/MiDaS", "MiDaS_small")
-            self.model.to(self.device)
-            self.model.eval()
-            
-            # Load corresponding transforms
-            midas_transforms = torch.hub.load("intel-isl/MiDaS", "transforms")
-            self.transform = midas_transforms.small_transform
+            # Download, export, compile and warm up off the event loop; requests
+            # wait in ensure_model_loaded until the backend choice is final
+            await loop.run_in_executor(self._executor, self._load_models)
+            await loop.run_in_executor(self._executor, self._warmup_backend)
             
             self.models_loaded = True
             logger.info("MiDaS small model loaded successfully")
@@ -76,17 +305,393 @@ class AutoFocusProcessor:
         finally:
             self.model_loading = False
 
-    def _estimate_depth(self, image_np: np.ndarray) -> np.ndarray:
-        """Estimate depth map using MiDaS"""
-        if not self.models_loaded:
-            raise ValueError("Depth model not loaded")
+    def _load_models(self):
+        """Load the model and build the inference backends (blocking)"""
+        # Input normalization constants and the mask smoothing kernel, on the device
+        self.input_mean = torch.tensor(MIDAS_MEAN, device=self.device).view(1, 3, 1, 1)
+        self.input_std = torch.tensor(MIDAS_STD, device=self.device).view(1, 3, 1, 1)
+        self.mask_kernel = torch.from_numpy(self._gauss_kx).to(self.device)
         
-        # Prepare input
-        input_tensor = self.transform(image_np).to(self.device)
+        # Load MiDaS small model (faster than full MiDaS)
+        self.model = torch.hub.load("intel-isl/MiDaS", "MiDaS_small")
+        self.model.to(self.device)
+        self.model.eval()
+            
+        # Use a TensorRT FP16 engine when available
+        if trt is not None and self.device.type == 'cuda':
+            try:
+                self._load_trt_engine()
+                logger.info("TensorRT FP16 engine loaded successfully")
+            except Exception as e:
+                logger.warning(f"TensorRT unavailable, using PyTorch inference: {e}")
+                self.trt_context = None
+            
+        # Otherwise run PyTorch in reduced precision and compile the graph
+        if self.trt_context is None and self.device.type == 'cuda':
+            # bf16 only where it is native (Ampere+); older GPUs emulate it slowly
+            self.autocast_dtype = (
+                torch.bfloat16 if torch.cuda.get_device_capability(self.device) >= (8, 0)
+                else torch.float16
+            )
+            self._eager_model = self.model
+            self.model = torch.compile(self.model, mode="reduce-overhead", fullgraph=True)
         
-        # Predict depth
+        # Without CUDA, prefer ONNX Runtime with pre-bound buffers
+        # (exported from the eager model)
+        if ort is not None and self.device.type == 'cpu':
+            try:
+                self._load_ort_session()
+                logger.info(f"ONNX Runtime session loaded ({self.ort_session.get_providers()[0]})")
+            except Exception as e:
+                logger.warning(f"ONNX Runtime unavailable, using PyTorch inference: {e}")
+                self.ort_session = None
+        
+        if self.ort_session is None and self.device.type != 'cuda':
+            # Eager path without ONNX Runtime: trace once for the fixed model input shape
+            dummy_input = torch.randn(1, 3, MIDAS_INPUT_SIZE, MIDAS_INPUT_SIZE, device=self.device)
+            with torch.no_grad():
+                self.model = torch.jit.trace(self.model, dummy_input, check_trace=False)
+
+    def _warmup_backend(self):
+        """Warm up, falling back to PyTorch if the TensorRT/ONNX Runtime backend fails.
+        
+        Warmup only primes caches, so a failure here is logged rather than
+        taking the loaded model offline.
+        """
+        try:
+            self._warmup()
+        except Exception as e:
+            logger.warning(f"Warmup failed: {e}")
+            if self.trt_context is None and self.ort_session is None:
+                return
+            logger.warning("Falling back to PyTorch inference")
+            self.trt_context = None
+            self.ort_session = None
+            try:
+                self._warmup()
+            except Exception as e:
+                logger.warning(f"Warmup failed: {e}")
+
+    def _warmup(self, iterations: int = 3):
+        """Run dummy inferences and a dummy blend so the first request runs at steady state"""
+        logger.info("Warming up depth model...")
+        dummy_image = np.zeros((MAX_PROCESSING_SIZE, MAX_PROCESSING_SIZE, 3), dtype=np.uint8)
+        
+        with torch.inference_mode(), self._pooled_stream():
+            # Model forward passes (torch.compile codegen, cuDNN tuning, CUDA context)
+            input_tensor = self._preprocess(dummy_image)
+            try:
+                self._warmup_model(input_tensor, iterations)
+            except Exception as e:
+                # torch.compile compiles lazily, so its failures surface here
+                if self._eager_model is None:
+                    raise
+                logger.warning(f"torch.compile failed, using eager PyTorch inference: {e}")
+                self.model = self._eager_model
+                self._eager_model = None
+                self._warmup_model(input_tensor, iterations)
+            
+            # Full depth, mask and blend path once (kernel caches, Numba JIT)
+            depth_tensor = self._estimate_depth_tensor(dummy_image)
+            if self.device.type == 'cuda':
+                focus_plane = self._find_subject_focus_plane_gpu(depth_tensor)
+                self._create_blur_mask_gpu(depth_tensor, focus_plane)
+                torch.cuda.synchronize()
+        
+        depth_map = depth_tensor.cpu().numpy()
+        blur_mask = self._create_blur_mask(depth_map, self._find_subject_focus_plane(depth_map))
+        self._apply_depth_blur_optimized(dummy_image, blur_mask)
+        logger.info("Warmup complete")
+
+    def _warmup_model(self, input_tensor: torch.Tensor, iterations: int):
+        """Run the model at every batch size the batch worker can produce.
+        
+        The passes run on the batch executor thread, like real batches, since
+        torch.compile keeps its CUDA graph recordings per thread.
+        """
+        if self.device.type == 'cuda':
+            torch.cuda.current_stream().synchronize()
+        for batch_size in [1] * iterations + list(range(2, MAX_BATCH_SIZE + 1)):
+            self._batch_executor.submit(self._run_batch, [input_tensor] * batch_size).result()
+
+    def shutdown(self):
+        """Stop the batch worker and worker threads"""
+        if self._batch_task is not None:
+            self._batch_task.cancel()
+            self._batch_task = None
+            self._batch_queue = None
+        self._executor.shutdown(wait=False)
+        self._batch_executor.shutdown(wait=False)
+
+    def _export_onnx(self, onnx_path: str, input_size: int):
+        """Export the torch model to ONNX at a fixed 1x3xNxN input shape"""
+        os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+        dummy_input = torch.randn(1, 3, input_size, input_size, device=self.device)
         with torch.no_grad():
-            depth_tensor = self.model(input_tensor)
+            torch.onnx.export(
+                self.model, dummy_input, onnx_path,
+                input_names=["image"], output_names=["depth"],
+                opset_version=ONNX_OPSET,
+            )
+
+    def _trt_engine_path(self) -> str:
+        """Engine cache path; engines only load on the TensorRT version and GPU they were built for"""
+        major, minor = torch.cuda.get_device_capability(self.device)
+        return os.path.join(
+            TRT_CACHE_DIR, f"midas_trt_fp16_trt{trt.__version__}_sm{major}{minor}.engine"
+        )
+
+    def _build_trt_engine(self, engine_path: str, trt_logger):
+        """Export MiDaS to ONNX and build a serialized TensorRT FP16 engine"""
+        logger.info("Building TensorRT FP16 engine (one-time)...")
+        onnx_path = os.path.join(TRT_CACHE_DIR, "midas_trt_fp16.onnx")
+        self._export_onnx(onnx_path, TRT_INPUT_SIZE)
+        
+        builder = trt.Builder(trt_logger)
+        network = builder.create_network(
+            1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH)
+        )
+        parser = trt.OnnxParser(network, trt_logger)
+        with open(onnx_path, "rb") as f:
+            if not parser.parse(f.read()):
+                errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+                raise RuntimeError(f"Failed to parse ONNX model: {errors}")
+        
+        config = builder.create_builder_config()
+        config.set_flag(trt.BuilderFlag.FP16)
+        serialized_engine = builder.build_serialized_network(network, config)
+        if serialized_engine is None:
+            raise RuntimeError("Failed to build TensorRT engine")
+        
+        with open(engine_path, "wb") as f:
+            f.write(serialized_engine)
+
+    def _load_trt_engine(self):
+        """Build (or load the cached) TensorRT FP16 engine for MiDaS"""
+        trt_logger = trt.Logger(trt.Logger.WARNING)
+        runtime = trt.Runtime(trt_logger)
+        engine_path = self._trt_engine_path()
+        
+        engine = None
+        if os.path.exists(engine_path):
+            with open(engine_path, "rb") as f:
+                engine = runtime.deserialize_cuda_engine(f.read())
+            if engine is None:
+                # Stale or corrupt cache entry; rebuild it
+                logger.warning(f"Cached TensorRT engine at {engine_path} is unusable, rebuilding")
+                os.remove(engine_path)
+        
+        if engine is None:
+            self._build_trt_engine(engine_path, trt_logger)
+            with open(engine_path, "rb") as f:
+                engine = runtime.deserialize_cuda_engine(f.read())
+            if engine is None:
+                raise RuntimeError(f"Failed to deserialize TensorRT engine at {engine_path}")
+        
+        # Pre-allocate device buffers and bind them to the execution context
+        self.trt_engine = engine
+        self.trt_context = engine.create_execution_context()
+        self.trt_stream = torch.cuda.Stream()
+        self.trt_input = torch.empty(
+            (1, 3, TRT_INPUT_SIZE, TRT_INPUT_SIZE), dtype=torch.float32, device=self.device
+        )
+        self.trt_output = torch.empty(
+            tuple(engine.get_tensor_shape("depth")), dtype=torch.float32, device=self.device
+        )
+        self.trt_context.set_tensor_address("image", self.trt_input.data_ptr())
+        self.trt_context.set_tensor_address("depth", self.trt_output.data_ptr())
+
+    def _ort_model_path(self) -> str:
+        """ONNX export cache path, keyed by the exporting torch version and opset"""
+        return os.path.join(
+            ORT_CACHE_DIR, f"midas_small_torch{torch.__version__}_opset{ONNX_OPSET}.onnx"
+        )
+
+    def _load_ort_session(self):
+        """Create an ONNX Runtime session with input/output buffers bound once"""
+        model_path = self._ort_model_path()
+        available = ort.get_available_providers()
+        providers = [provider for provider in ORT_PROVIDERS if provider in available]
+        
+        session = None
+        if os.path.exists(model_path):
+            try:
+                session = ort.InferenceSession(model_path, providers=providers)
+            except Exception as e:
+                # Stale or corrupt cache entry; re-export it
+                logger.warning(f"Cached ONNX model at {model_path} is unusable, re-exporting: {e}")
+                os.remove(model_path)
+        
+        if session is None:
+            logger.info("Exporting MiDaS to ONNX (one-time)...")
+            self._export_onnx(model_path, ORT_INPUT_SIZE)
+            session = ort.InferenceSession(model_path, providers=providers)
+        
+        # Pre-allocate host buffers and bind them to the session
+        self.ort_input = np.empty((1, 3, ORT_INPUT_SIZE, ORT_INPUT_SIZE), dtype=np.float32)
+        self.ort_output = np.empty(session.get_outputs()[0].shape, dtype=np.float32)
+        binding = session.io_binding()
+        binding.bind_ortvalue_input("image", ort.OrtValue.ortvalue_from_numpy(self.ort_input))
+        binding.bind_ortvalue_output("depth", ort.OrtValue.ortvalue_from_numpy(self.ort_output))
+        
+        self.ort_session = session
+        self.ort_binding = binding
+
+    def _network_input_size(self, height: int, width: int) -> Tuple[int, int]:
+        """Model input size: fit within 256x256, keep aspect ratio, multiple of 32
+        (matches MiDaS small_transform)"""
+        if self.trt_context is not None:
+            # The engine was built for a fixed input shape
+            return TRT_INPUT_SIZE, TRT_INPUT_SIZE
+        if self.ort_session is not None:
+            return ORT_INPUT_SIZE, ORT_INPUT_SIZE
+        
+        scale = MIDAS_INPUT_SIZE / max(height, width)
+        new_height = max(32, round(height * scale / 32) * 32)
+        new_width = max(32, round(width * scale / 32) * 32)
+        return new_height, new_width
+
+    def _preprocess(self, image_np: np.ndarray) -> torch.Tensor:
+        """Upload the uint8 RGB image and resize/normalize it on the device"""
+        height, width = image_np.shape[:2]
+        
+        image_tensor = torch.from_numpy(image_np).to(self.device, non_blocking=True)
+        image_tensor = image_tensor.permute(2, 0, 1).unsqueeze(0).float().div_(255.0)
+        image_tensor = F.interpolate(
+            image_tensor,
+            size=self._network_input_size(height, width),
+            mode="bicubic",
+            align_corners=False,
+        )
+        
+        return (image_tensor - self.input_mean) / self.input_std
+
+    def _infer(self, input_tensor: torch.Tensor) -> torch.Tensor:
+        """Run MiDaS on a preprocessed (N, 3, H, W) batch"""
+        if self.trt_context is not None:
+            # The engine was built with a batch size of 1
+            return torch.cat([self._infer_trt(item[None]) for item in input_tensor])
+        if self.ort_session is not None:
+            return torch.cat([self._infer_ort(item[None]) for item in input_tensor])
+        
+        if self.autocast_dtype is not None:
+            with torch.autocast(device_type='cuda', dtype=self.autocast_dtype):
+                depth_tensor = self.model(input_tensor)
+            return depth_tensor.float()
+        
+        return self.model(input_tensor)
+
+    def _infer_trt(self, input_tensor: torch.Tensor) -> torch.Tensor:
+        """Run the TensorRT engine on a single preprocessed image"""
+        # The execution context and its bound buffers are shared
+        with self._trt_lock:
+            self.trt_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.trt_stream):
+                self.trt_input.copy_(input_tensor, non_blocking=True)
+                self.trt_context.execute_async_v3(self.trt_stream.cuda_stream)
+                depth_tensor = self.trt_output.clone()
+            self.trt_stream.synchronize()
+        # Allocated on trt_stream but consumed on the caller's stream; keep the
+        # caching allocator from reusing it while the caller's kernels are queued
+        depth_tensor.record_stream(torch.cuda.current_stream())
+        return depth_tensor
+
+    def _infer_ort(self, input_tensor: torch.Tensor) -> torch.Tensor:
+        """Run the ONNX Runtime session on a single preprocessed image"""
+        # The binding and its buffers are shared
+        with self._ort_lock:
+            torch.from_numpy(self.ort_input).copy_(input_tensor)
+            self.ort_session.run_with_iobinding(self.ort_binding)
+            depth_tensor = torch.from_numpy(self.ort_output.copy())
+        return depth_tensor
+
+    def _start_batch_worker(self):
+        """Start the micro-batching worker on the running event loop"""
+        if self._batch_task is not None:
+            return
+        if self.device.type == 'cuda' and self._streams is None:
+            self._streams = _StreamPool(self.device)
+        self._batch_loop = asyncio.get_running_loop()
+        self._batch_queue = asyncio.Queue()
+        self._batch_task = self._batch_loop.create_task(self._batch_worker())
+
+    async def _submit(self, input_tensor: torch.Tensor) -> torch.Tensor:
+        """Queue a preprocessed image for the next batch and wait for its depth"""
+        future = self._batch_loop.create_future()
+        await self._batch_queue.put((input_tensor, future))
+        return await future
+
+    async def _batch_worker(self):
+        """Collect queued images for up to BATCH_WAIT_MS and run them together"""
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            batch = [await self._batch_queue.get()]
+            deadline = loop.time() + BATCH_WAIT_MS / 1000
+            while len(batch) < MAX_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._batch_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Only images with the same input shape can share a forward pass
+            groups: Dict[Tuple[int, ...], List[Tuple[torch.Tensor, asyncio.Future]]] = {}
+            for input_tensor, future in batch:
+                groups.setdefault(tuple(input_tensor.shape[1:]), []).append((input_tensor, future))
+            
+            for items in groups.values():
+                tensors = [input_tensor for input_tensor, _ in items]
+                try:
+                    results = await loop.run_in_executor(
+                        self._batch_executor, self._run_batch, tensors
+                    )
+                except Exception as e:
+                    for _, future in items:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, future), depth_tensor in zip(items, results):
+                    if not future.done():
+                        future.set_result(depth_tensor)
+
+    def _run_batch(self, tensors: List[torch.Tensor]) -> Tuple[torch.Tensor, ...]:
+        """Run one batched forward pass (on the batch executor thread)"""
+        with torch.inference_mode(), self._pooled_stream():
+            depth_tensor = self._infer(torch.cat(tensors))
+            if self.device.type == 'cuda':
+                torch.cuda.current_stream().synchronize()
+        return depth_tensor.split(1)
+
+    def _estimate_depth_tensor(self, image_np: np.ndarray,
+                               valid_shape: Optional[Tuple[int, int]] = None) -> torch.Tensor:
+        """Estimate a normalized depth map using MiDaS, kept on the device
+        
+        If valid_shape is given, only that top-left (height, width) region
+        (the un-padded image) sets the 0-1 range; the rest is clamped to it.
+        """
+        if self.model is None:
+            raise ValueError("Depth model not loaded")
+        
+        # Predict depth
+        with torch.inference_mode():
+            # Prepare input
+            input_tensor = self._preprocess(image_np)
+            
+            if self._batch_queue is not None:
+                # Called from a worker thread: hand off to the batch worker
+                if self.device.type == 'cuda':
+                    torch.cuda.current_stream().synchronize()
+                depth_tensor = asyncio.run_coroutine_threadsafe(
+                    self._submit(input_tensor), self._batch_loop
+                ).result()
+                if self.device.type == 'cuda':
+                    # Allocated on the batch thread's stream; see _infer_trt
+                    depth_tensor.record_stream(torch.cuda.current_stream())
+            else:
+                depth_tensor = self._infer(input_tensor)
             
             # Interpolate to original image size
             depth_tensor = F.interpolate(
@@ -95,14 +700,23 @@ class AutoFocusProcessor:
                 mode="bicubic",
                 align_corners=False,
             ).squeeze()
+            
+            # Normalize depth values to 0-1 range
+            valid = depth_tensor
+            if valid_shape is not None:
+                valid = depth_tensor[:valid_shape[0], :valid_shape[1]]
+            depth_min = valid.amin()
+            depth_max = valid.amax()
+            depth_tensor = (depth_tensor - depth_min) / (depth_max - depth_min).clamp_min(1e-8)
+            if valid_shape is not None:
+                depth_tensor = depth_tensor.clamp_(0, 1)
         
-        # Convert to numpy and normalize
-        depth_map = depth_tensor.cpu().numpy()
-        
-        # Normalize depth values to 0-1 range
-        depth_map = (depth_map - depth_map.min()) / (depth_map.max() - depth_map.min())
-        
-        return depth_map
+        return depth_tensor
+
+    def _estimate_depth(self, image_np: np.ndarray,
+                        valid_shape: Optional[Tuple[int, int]] = None) -> np.ndarray:
+        """Estimate depth map using MiDaS"""
+        return self._estimate_depth_tensor(image_np, valid_shape).cpu().numpy()
 
     def _find_subject_focus_plane(self, depth_map: np.ndarray) -> float:
         """Determine the focus plane based on the subject (typically foreground)"""
@@ -114,13 +728,24 @@ class AutoFocusProcessor:
         center_region = depth_map[center_h_start:center_h_end, center_w_start:center_w_end]
         
         # Use the most common depth in center region as focus plane
-        # We'll use the median depth of the center region
-        focus_depth = np.median(center_region)
+        # We'll use the median depth of the center region (partial sort, in place;
+        # order doesn't matter for the histogram below)
+        center_values = center_region.flatten()
+        mid = center_values.size // 2
+        center_values.partition(mid)
+        focus_depth = center_values[mid]
         
         # Alternative: Find the most frequent depth value in center
-        hist, bin_edges = np.histogram(center_region.flatten(), bins=50)
-        most_common_bin = np.argmax(hist)
-        focus_depth_alt = (bin_edges[most_common_bin] + bin_edges[most_common_bin + 1]) / 2
+        # (50-bin histogram over the center's range via bincount)
+        center_min = center_values.min()
+        bin_width = (center_values.max() - center_min) / 50
+        if bin_width > 0:
+            bins = ((center_values - center_min) / bin_width).astype(np.int32)
+            np.minimum(bins, 49, out=bins)
+            most_common_bin = np.bincount(bins, minlength=50).argmax()
+            focus_depth_alt = center_min + (most_common_bin + 0.5) * bin_width
+        else:
+            focus_depth_alt = center_min
         
         # Use average of both methods for more stability
         focus_plane = (focus_depth + focus_depth_alt) / 2
@@ -128,80 +753,132 @@ class AutoFocusProcessor:
         return float(focus_plane)
 
     def _create_blur_mask(self, depth_map: np.ndarray, focus_plane: float, 
-                         focus_range: float = 0.1) -> np.ndarray:
+                         focus_range: float = 0.1,
+                         scratch: Optional[np.ndarray] = None,
+                         dst: Optional[np.ndarray] = None,
+                         valid_shape: Optional[Tuple[int, int]] = None) -> np.ndarray:
         """Create blur intensity mask based on distance from focus plane"""
-        
-        # Calculate distance from focus plane
-        distance_from_focus = np.abs(depth_map - focus_plane)
+        if scratch is None:
+            scratch = np.empty(depth_map.shape, dtype=np.float32)
+        valid_height, valid_width = valid_shape or depth_map.shape
         
         # Create blur intensity map
         # Areas close to focus plane get little/no blur
         # Areas far from focus plane get more blur
-        
-        # Normalize distance to 0-1 range
-        max_distance = np.max(distance_from_focus)
-        if max_distance > 0:
-            blur_intensity = distance_from_focus / max_distance
+        if _fused_blur_intensity is not None:
+            with self._numba_lock:
+                blur_intensity = _fused_blur_intensity(
+                    depth_map, np.float32(focus_plane), np.float32(focus_range),
+                    valid_height, valid_width, scratch
+                )
         else:
-            blur_intensity = np.zeros_like(depth_map)
-        
-        # Apply focus range - areas within focus_range get no blur
-        blur_intensity[distance_from_focus <= focus_range] = 0
+            # Calculate distance from focus plane
+            distance_from_focus = np.subtract(depth_map, focus_plane, out=scratch)
+            np.abs(distance_from_focus, out=distance_from_focus)
+            in_focus = distance_from_focus <= focus_range
+            
+            # Normalize distance to 0-1 range over the valid region (in place)
+            blur_intensity = distance_from_focus
+            max_distance = np.max(blur_intensity[:valid_height, :valid_width])
+            if max_distance > 0:
+                blur_intensity /= max_distance
+                np.minimum(blur_intensity, 1, out=blur_intensity)
+            else:
+                blur_intensity.fill(0)
+            
+            # Apply focus range - areas within focus_range get no blur
+            blur_intensity[in_focus] = 0
         
         # Smooth the blur mask to avoid harsh transitions
-        blur_mask = cv2.GaussianBlur(blur_intensity.astype(np.float32), (21, 21), 0)
+        blur_mask = cv2.sepFilter2D(
+            blur_intensity, cv2.CV_32F, self._gauss_kx, self._gauss_kx, dst=dst
+        )
         
         return blur_mask
 
-    def _apply_depth_blur(self, image_np: np.ndarray, blur_mask: np.ndarray, 
-                         max_blur_radius: int = 15) -> np.ndarray:
-        """Apply variable blur based on depth mask"""
+    def _get_gaussian_kernel(self, kernel_size: int, sigma: float) -> np.ndarray:
+        """Return a cached 1D Gaussian kernel for separable filtering"""
+        key = (kernel_size, sigma)
+        with self._kernel_lock:
+            kernel = self._blur_kernels.get(key)
+            if kernel is None:
+                kernel = cv2.getGaussianKernel(kernel_size, sigma).astype(np.float32)
+                self._blur_kernels[key] = kernel
+                if len(self._blur_kernels) > 8:
+                    self._blur_kernels.popitem(last=False)
+            else:
+                self._blur_kernels.move_to_end(key)
+        return kernel
+
+    def _gaussian_blur(self, image_np: np.ndarray, kernel_size: int, sigma: float,
+                       ddepth: int = cv2.CV_32F,
+                       dst: Optional[np.ndarray] = None) -> np.ndarray:
+        """Separable Gaussian blur (float32 or uint8 output) with a cached kernel"""
+        kernel = self._get_gaussian_kernel(kernel_size, sigma)
+        return cv2.sepFilter2D(image_np, ddepth, kernel, kernel, dst=dst)
+
+    def _find_subject_focus_plane_gpu(self, depth_tensor: torch.Tensor) -> torch.Tensor:
+        """Device version of _find_subject_focus_plane (returns a 0-d tensor)"""
+        height, width = depth_tensor.shape
         
-        result = image_np.copy().astype(np.float32)
+        center_region = depth_tensor[height // 4:3 * height // 4, width // 4:3 * width // 4]
+        focus_depth = torch.quantile(center_region.flatten(), 0.5)
         
-        # Create multiple blur levels for smooth transition
-        blur_levels = []
-        for i in range(1, max_blur_radius + 1, 2):  # Odd numbers for kernel size
-            blurred = cv2.GaussianBlur(image_np, (i*2+1, i*2+1), i/3)
-            blur_levels.append(blurred.astype(np.float32))
+        center_min = center_region.amin()
+        center_max = center_region.amax()
+        hist = torch.histc(center_region, bins=50)
+        bin_width = (center_max - center_min) / 50
+        focus_depth_alt = center_min + (hist.argmax() + 0.5) * bin_width
         
-        # Apply blur based on mask intensity
-        height, width = blur_mask.shape
+        return (focus_depth + focus_depth_alt) / 2
+
+    def _create_blur_mask_gpu(self, depth_tensor: torch.Tensor, focus_plane: torch.Tensor,
+                              focus_range: float = 0.1,
+                              valid_shape: Optional[Tuple[int, int]] = None) -> torch.Tensor:
+        """Build the blur mask without leaving the device"""
+        # Distance from focus plane, normalized to 0-1 over the valid region
+        distance_from_focus = (depth_tensor - focus_plane).abs()
+        valid_height, valid_width = valid_shape or depth_tensor.shape
+        max_distance = distance_from_focus[:valid_height, :valid_width].amax()
+        blur_intensity = (distance_from_focus / max_distance.clamp_min(1e-8)).clamp_(max=1)
         
-        for y in range(height):
-            for x in range(width):
-                blur_intensity = blur_mask[y, x]
-                
-                if blur_intensity > 0:
-                    # Determine which blur level to use
-                    blur_level_idx = min(int(blur_intensity * len(blur_levels)), len(blur_levels) - 1)
-                    
-                    # Blend between original and blurred
-                    alpha = blur_intensity
-                    result[y, x] = (1 - alpha) * image_np[y, x] + alpha * blur_levels[blur_level_idx][y, x]
-        
-        return result.astype(np.uint8)
+        # Apply focus range - areas within focus_range get no blur
+        blur_intensity = torch.where(
+            distance_from_focus <= focus_range,
+            torch.zeros_like(blur_intensity),
+            blur_intensity,
+        )
+        
+        # Smooth the blur mask with a separable Gaussian (reflect-101 border like OpenCV)
+        pad = self.mask_kernel.shape[0] // 2
+        blur_mask = F.pad(blur_intensity[None, None], (pad, pad, pad, pad), mode='reflect')
+        blur_mask = F.conv2d(blur_mask, self.mask_kernel.view(1, 1, -1, 1))
+        blur_mask = F.conv2d(blur_mask, self.mask_kernel.view(1, 1, 1, -1))
+        
+        return blur_mask[0, 0]
 
     def _apply_depth_blur_optimized(self, image_np: np.ndarray, blur_mask: np.ndarray, 
-                                   max_blur_radius: int = 15) -> np.ndarray:
+                                   max_blur_radius: int = 15,
+                                   blurred_dst: Optional[np.ndarray] = None,
+                                   weights_dst: Optional[np.ndarray] = None,
+                                   dst: Optional[np.ndarray] = None) -> np.ndarray:
         """Optimized depth blur using vectorized operations"""
         
-        # Create heavily blurred version
+        # Create heavily blurred version (uint8, like the input)
         kernel_size = max_blur_radius * 2 + 1
-        blurred_image = cv2.GaussianBlur(image_np, (kernel_size, kernel_size), max_blur_radius/3)
-        
-        # Expand blur mask to match image channels
-        blur_mask_3d = np.expand_dims(blur_mask, axis=2)
-        blur_mask_3d = np.repeat(blur_mask_3d, 3, axis=2)
-        
-        # Blend original and blurred images
-        result = (1 - blur_mask_3d) * image_np + blur_mask_3d * blurred_image
+        blurred_image = self._gaussian_blur(
+            image_np, kernel_size, max_blur_radius / 3, ddepth=cv2.CV_8U, dst=blurred_dst
+        )
         
-        return result.astype(np.uint8)
+        # Blend original and blurred images in one fused uint8 pass:
+        # result = (1 - mask) * image + mask * blurred
+        original_weights = np.subtract(1.0, blur_mask, out=weights_dst, dtype=np.float32)
+        return cv2.blendLinear(image_np, blurred_image, original_weights, blur_mask, dst=dst)
 
     async def process_auto_focus(self, image_bytes: bytes, 
                                focus_strength: float = 1.0,
-                               blur_radius: int = 15) -> Dict[str, Any]:
+                               blur_radius: int = 15,
+                               return_depth: bool = False) -> Dict[str, Any]:
         """Process image with auto focus effect like Canva"""
         
         # Ensure model is loaded before processing
@@ -210,98 +887,251 @@ class AutoFocusProcessor:
         if not self.models_loaded:
             raise HTTPException(status_code=503, detail="Depth model failed to load")
         
+        self._start_batch_worker()
+        
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self._process_auto_focus_sync,
+            image_bytes, focus_strength, blur_radius, return_depth
+        )
+
+    @staticmethod
+    def _jpeg_exif_orientation(image_bytes: bytes) -> int:
+        """EXIF orientation tag (1-8) of a JPEG, or 1 if it has none"""
+        try:
+            # Image.open only parses the headers; the pixels are never decoded
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                return image.getexif().get(0x0112, 1)
+        except Exception:
+            return 1  # Malformed EXIF; decode as stored
+
+    @staticmethod
+    def _apply_exif_orientation(image_np: np.ndarray, orientation: int) -> np.ndarray:
+        """Rotate/flip a decoded image upright, like cv2.imdecode does"""
+        if orientation == 2:
+            return cv2.flip(image_np, 1)
+        if orientation == 3:
+            return cv2.rotate(image_np, cv2.ROTATE_180)
+        if orientation == 4:
+            return cv2.flip(image_np, 0)
+        if orientation == 5:
+            return cv2.transpose(image_np)
+        if orientation == 6:
+            return cv2.rotate(image_np, cv2.ROTATE_90_CLOCKWISE)
+        if orientation == 7:
+            return cv2.flip(cv2.transpose(image_np), -1)
+        if orientation == 8:
+            return cv2.rotate(image_np, cv2.ROTATE_90_COUNTERCLOCKWISE)
+        return image_np
+
+    def _decode_image(self, image_bytes: bytes) -> np.ndarray:
+        """Decode uploaded image bytes to an RGB uint8 array"""
+        if self._jpeg is not None and image_bytes[:2] == b'\xff\xd8':
+            try:
+                image_np = self._jpeg.decode(image_bytes, pixel_format=TJPF_RGB)
+            except Exception:
+                image_np = None  # e.g. CMYK; OpenCV handles these
+            if image_np is not None:
+                return self._apply_exif_orientation(
+                    image_np, self._jpeg_exif_orientation(image_bytes)
+                )
+        
+        image_bgr = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if image_bgr is None:
+            raise ValueError("Could not decode image")
+        return cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+
+    def _encode_jpeg(self, image_np: np.ndarray, quality: int = 95) -> bytes:
+        """Encode an RGB (H, W, 3) or grayscale (H, W) uint8 array as JPEG"""
+        if self._jpeg is not None:
+            image_np = np.ascontiguousarray(image_np)  # TurboJPEG assumes packed rows
+            if image_np.ndim == 2:
+                return self._jpeg.encode(
+                    image_np[..., None], quality=quality,
+                    pixel_format=TJPF_GRAY, jpeg_subsample=TJSAMP_GRAY,
+                )
+            return self._jpeg.encode(image_np, quality=quality, pixel_format=TJPF_RGB)
+        
+        if image_np.ndim == 3:
+            image_np = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
+        ok, buffer = cv2.imencode('.jpg', image_np, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise ValueError("Could not encode JPEG")
+        return buffer.tobytes()
+
+    def _letterbox(self, image_np: np.ndarray, size: int,
+                   dst: Optional[np.ndarray] = None) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """Downscale an image whose long side exceeds size, then pad to size x size.
+        
+        Smaller images are only padded, never upscaled, so blur_radius keeps
+        applying at their native resolution. Padding is added at the
+        bottom/right by reflection, so blurs near the image edges see the same
+        neighbourhood as an OpenCV reflect-101 border.
+        Returns the padded image and the (height, width) of the valid region.
+        """
+        height, width = image_np.shape[:2]
+        if max(height, width) > size:
+            scale = size / max(height, width)
+            height = min(size, max(1, int(height * scale)))
+            width = min(size, max(1, int(width * scale)))
+            image_np = cv2.resize(image_np, (width, height))
+        padded = cv2.copyMakeBorder(
+            image_np, 0, size - height, 0, size - width, cv2.BORDER_REFLECT_101, dst=dst
+        )
+        return padded, (height, width)
+
+    def _pooled_stream(self):
+        """Context running CUDA work on a pooled stream (no-op on CPU)"""
+        if self._streams is None:
+            return nullcontext()
+        return self._streams.stream()
+
+    def _process_auto_focus_sync(self, image_bytes: bytes, focus_strength: float,
+                                 blur_radius: int, return_depth: bool) -> Dict[str, Any]:
+        """Blocking part of process_auto_focus, run on the worker thread pool"""
+        pooled = self._buffers.acquire()
+        slot = self._streams.acquire() if self._streams is not None else None
+        
         try:
-            # Load image
-            image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-            image_np = np.array(image)
-            original_height, original_width = image_np.shape[:2]
-            
-            # Resize for processing if too large (depth estimation is expensive)
-            max_size = 512
-            if max(original_height, original_width) > max_size:
-                scale = max_size / max(original_height, original_width)
-                new_width = int(original_width * scale)
-                new_height = int(original_height * scale)
-                processed_image = cv2.resize(image_np, (new_width, new_height))
-                scale_back = True
-            else:
-                processed_image = image_np.copy()
-                scale_back = False
+            if slot is None:
+                return self._run_auto_focus(
+                    pooled, image_bytes, focus_strength, blur_radius, return_depth
+                )
             
-            # Estimate depth map
-            logger.info("Estimating depth map...")
-            depth_map = self._estimate_depth(processed_image)
+            # Stage host<->device transfers through this stream's pinned buffers
+            buffers = {**pooled, "image": slot["image"].numpy(), "maps": slot["maps"].numpy()}
+            with torch.cuda.stream(slot["stream"]):
+                return self._run_auto_focus(
+                    buffers, image_bytes, focus_strength, blur_radius, return_depth
+                )
+        except Exception as e:
+            logger.error(f"Error processing auto focus: {e}")
+            raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
+        finally:
+            self._buffers.release(pooled)
+            if slot is not None:
+                self._streams.release(slot)
+
+    def _run_auto_focus(self, buffers: Dict[str, np.ndarray], image_bytes: bytes,
+                        focus_strength: float, blur_radius: int,
+                        return_depth: bool) -> Dict[str, Any]:
+        """Decode, estimate depth, blur and encode one image"""
+        view = self._buffers.view
+        
+        # Load image
+        image_np = self._decode_image(image_bytes)
+        original_height, original_width = image_np.shape[:2]
+        
+        # Letterbox to a fixed square so every kernel downstream sees one shape
+        # (images larger than MAX_PROCESSING_SIZE are downscaled first)
+        height = width = MAX_PROCESSING_SIZE
+        processed_image, valid_shape = self._letterbox(
+            image_np, MAX_PROCESSING_SIZE, dst=view(buffers["image"], (height, width, 3))
+        )
+        valid_height, valid_width = valid_shape
+        scale_back = valid_shape != (original_height, original_width)
+        maps = view(buffers["maps"], (2, height, width))
+        
+        # Estimate depth map
+        logger.info("Estimating depth map...")
+        focus_range = 0.1 / focus_strength  # Adjustable focus range
+        
+        if self.device.type == 'cuda':
+            # Focus plane and blur mask are computed on the GPU,
+            # with a single async transfer back into the (pinned) host buffers
+            depth_tensor = self._estimate_depth_tensor(processed_image, valid_shape)
+            with torch.inference_mode():
+                focus_plane = self._find_subject_focus_plane_gpu(
+                    depth_tensor[:valid_height, :valid_width]
+                )
+                blur_mask = self._create_blur_mask_gpu(
+                    depth_tensor, focus_plane, focus_range, valid_shape
+                )
+                if return_depth:
+                    torch.from_numpy(maps).copy_(
+                        torch.stack([depth_tensor, blur_mask]), non_blocking=True
+                    )
+                else:
+                    torch.from_numpy(maps[1]).copy_(blur_mask, non_blocking=True)
+                torch.cuda.current_stream().synchronize()
+            depth_map, blur_mask = maps
+            focus_plane = float(focus_plane)
+        else:
+            depth_map = self._estimate_depth(processed_image, valid_shape)
             
             # Find focus plane (subject depth)
-            focus_plane = self._find_subject_focus_plane(depth_map)
+            focus_plane = self._find_subject_focus_plane(depth_map[:valid_height, :valid_width])
             
             # Create blur mask
-            focus_range = 0.1 / focus_strength  # Adjustable focus range
-            blur_mask = self._create_blur_mask(depth_map, focus_plane, focus_range)
-            
-            # Apply depth-based blur
-            result_image = self._apply_depth_blur_optimized(
-                processed_image, blur_mask, blur_radius
+            blur_mask = self._create_blur_mask(
+                depth_map, focus_plane, focus_range,
+                scratch=view(buffers["scratch"], (height, width)),
+                dst=maps[1],
+                valid_shape=valid_shape,
             )
-            
-            # Scale back to original size if needed
-            if scale_back:
-                result_image = cv2.resize(result_image, (original_width, original_height))
-                depth_map = cv2.resize(depth_map, (original_width, original_height))
-                blur_mask = cv2.resize(blur_mask, (original_width, original_height))
-            
-            # Convert result to base64 for response
-            result_pil = Image.fromarray(result_image)
-            result_buffer = io.BytesIO()
-            result_pil.save(result_buffer, format='JPEG', quality=95)
-            result_base64 = base64.b64encode(result_buffer.getvalue()).decode()
-            
-            # Convert depth map to base64 for visualization (optional)
-            depth_vis = (depth_map * 255).astype(np.uint8)
-            depth_pil = Image.fromarray(depth_vis, mode='L')
-            depth_buffer = io.BytesIO()
-            depth_pil.save(depth_buffer, format='JPEG')
-            depth_base64 = base64.b64encode(depth_buffer.getvalue()).decode()
-            
-            return {
-                "processed_image": f"data:image/jpeg;base64,{result_base64}",
-                "depth_map": f"data:image/jpeg;base64,{depth_base64}",
-                "focus_plane_depth": focus_plane,
-                "image_size": {
-                    "width": original_width,
-                    "height": original_height
-                },
-                "processing_info": {
-                    "focus_strength": focus_strength,
-                    "blur_radius": blur_radius,
-                    "scaled_for_processing": scale_back
-                }
+        
+        # Apply depth-based blur
+        result_image = self._apply_depth_blur_optimized(
+            processed_image, blur_mask, blur_radius,
+            blurred_dst=view(buffers["blurred"], (height, width, 3)),
+            weights_dst=view(buffers["scratch"], (height, width)),
+            dst=view(buffers["result"], (height, width, 3)),
+        )
+        
+        # Undo the letterbox padding
+        result_image = result_image[:valid_height, :valid_width]
+        depth_map = depth_map[:valid_height, :valid_width]
+        
+        # Scale back to original size if needed. The decoded image is no longer
+        # needed, so it is reused as the output buffer. The depth map preview
+        # stays at processing resolution.
+        if scale_back:
+            result_image = cv2.resize(
+                result_image, (original_width, original_height),
+                dst=image_np, interpolation=cv2.INTER_LINEAR,
+            )
+        
+        # Convert result to base64 for response
+        result_base64 = base64.b64encode(self._encode_jpeg(result_image)).decode()
+        
+        response = {
+            "processed_image": f"data:image/jpeg;base64,{result_base64}",
+            "focus_plane_depth": focus_plane,
+            "image_size": {
+                "width": original_width,
+                "height": original_height
+            },
+            "processing_info": {
+                "focus_strength": focus_strength,
+                "blur_radius": blur_radius,
+                "scaled_for_processing": scale_back
             }
-            
-        except Exception as e:
-            logger.error(f"Error processing auto focus: {e}")
-            raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
+        }
+        
+        # Convert depth map to base64 for visualization (optional)
+        if return_depth:
+            depth_vis = (depth_map * 255).astype(np.uint8)
+            depth_base64 = base64.b64encode(self._encode_jpeg(depth_vis)).decode()
+            response["depth_map"] = f"data:image/jpeg;base64,{depth_base64}"
+        
+        return response
 
 # Initialize processor
 processor = AutoFocusProcessor()
 
-# Remove the startup event that was causing the timeout
-# @app.on_event("startup")
-# async def startup_event():
-#     """Load depth model when server starts"""
-#     await processor.load_depth_model()
-
 @app.post("/auto-focus")
 async def auto_focus_blur(
     file: UploadFile = File(...),
     focus_strength: float = 1.0,
-    blur_radius: int = 15
+    blur_radius: int = 15,
+    return_depth: bool = False
 ):
     """Apply auto focus effect like Canva
     
     Parameters:
     - focus_strength: Controls focus range (0.5-2.0, default 1.0)
     - blur_radius: Maximum blur intensity (5-25, default 15)
+    - return_depth: Include the depth map visualization (default false)
     """
     
     # Validate file type
@@ -321,7 +1151,7 @@ async def auto_focus_blur(
         
         # Process with auto focus (model will be loaded if needed)
         result = await processor.process_auto_focus(
-            image_bytes, focus_strength, blur_radius
+            image_bytes, focus_strength, blur_radius, return_depth
         )
         
         return JSONResponse(content=result)
@@ -355,7 +1185,8 @@ async def root():
         },
         "parameters": {
             "focus_strength": "0.1-3.0 (default: 1.0)",
-            "blur_radius": "3-50 (default: 15)"
+            "blur_radius": "3-50 (default: 15)",
+            "return_depth": "true/false (default: false)"
         }
     }
 
@@ -142,7 +142,7 @@ class DepthBasedBlurProcessor {
 
             this.updateProgress(30, 'Uploading image...');
 
-            const response = await fetch('http://localhost:8000/auto-focus', {
+            const response = await fetch('http://localhost:8000/auto-focus?return_depth=true', {
                 method: 'POST',
                 body: formData
             });